@@ -3,6 +3,7 @@ from typing import Dict, Generator, List, Optional, Tuple
 
 import boto3
 from botocore.client import BaseClient
+from botocore.config import Config
 
 from dstack.backend.aws import (
     artifacts,
@@ -27,6 +28,9 @@ from dstack.core.run import RunHead
 from dstack.core.secret import Secret
 from dstack.core.tag import TagHead
 
+# Enough connections for the thread pools in runners to share a client
+CLIENT_MAX_POOL_CONNECTIONS = 32
+
 
 class AwsBackend(RemoteBackend):
     @property
@@ -35,53 +39,45 @@ class AwsBackend(RemoteBackend):
 
     def __init__(self):
         self.backend_config = AWSConfig()
+        self._clients: Dict[Tuple[Optional[str], Optional[str], str], BaseClient] = {}
         try:
             self.backend_config.load()
             self._loaded = True
         except ConfigError:
             self._loaded = False
 
+    def _client(self, service_name: str, **config) -> BaseClient:
+        key = (self.backend_config.profile_name, self.backend_config.region_name, service_name)
+        client = self._clients.get(key)
+        if client is None:
+            session = boto3.Session(
+                profile_name=self.backend_config.profile_name,
+                region_name=self.backend_config.region_name,
+            )
+            client = session.client(
+                service_name,
+                config=Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS, **config),
+            )
+            self._clients[key] = client
+        return client
+
     def _s3_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("s3")
+        return self._client("s3")
 
     def _ec2_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("ec2")
+        return self._client("ec2", retries={"mode": "adaptive", "max_attempts": 5})
 
     def _iam_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("iam")
+        return self._client("iam")
 
     def _logs_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("logs")
+        return self._client("logs")
 
     def _secretsmanager_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("secretsmanager")
+        return self._client("secretsmanager")
 
     def _sts_client(self) -> BaseClient:
-        session = boto3.Session(
-            profile_name=self.backend_config.profile_name,
-            region_name=self.backend_config.region_name,
-        )
-        return session.client("sts")
+        return self._client("sts")
 
     def configure(self):
         config.configure(
@@ -134,6 +130,19 @@ class AwsBackend(RemoteBackend):
             abort,
         )
 
+    def stop_jobs(self, repo_address: RepoAddress, run_name: Optional[str], abort: bool) -> bool:
+        job_heads = self.list_job_heads(repo_address, run_name)
+        job_ids = [job_head.job_id for job_head in job_heads if job_head.status.is_unfinished()]
+        runners.stop_jobs(
+            self._ec2_client(),
+            self._s3_client(),
+            self.backend_config.bucket_name,
+            repo_address,
+            job_ids,
+            abort,
+        )
+        return bool(job_heads)
+
     def list_job_heads(self, repo_address: RepoAddress, run_name: Optional[str] = None):
         return jobs.list_job_heads(
             self._s3_client(), self.backend_config.bucket_name, repo_address, run_name
@@ -1,9 +1,11 @@
 import json
+import random
 import sys
+import threading
 import time
 import uuid
-from functools import cmp_to_key, reduce
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Set, Tuple
 
 import yaml
 from botocore.client import BaseClient
@@ -11,13 +13,89 @@ from botocore.client import BaseClient
 from dstack import version
 from dstack.backend.aws import jobs, logs
 from dstack.core.instance import InstanceType
-from dstack.core.job import Job, JobStatus, Requirements
+from dstack.core.job import Job, JobHead, JobStatus, Requirements
 from dstack.core.repo import RepoAddress
 from dstack.core.request import RequestHead, RequestStatus
 from dstack.core.runners import Gpu, Resources, Runner
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 CREATE_INSTANCE_RETRY_RATE_SECS = 3
 
+CREATE_INSTANCE_RETRY_MAX_SECS = 30
+
+INSTANCE_TYPES_CACHE_TTL_SECS = 15 * 60
+
+CPU_INSTANCE_TYPE_FAMILIES = ["c5.*", "m5.*"]
+
+GPU_INSTANCE_TYPE_FAMILIES = ["p2.*", "p3.*", "p4d.*", "p4de.*"]
+
+_INSTANCE_TYPES_CACHE: Dict[Tuple[str, bool], Tuple[float, List[InstanceType]]] = {}
+
+AMI_IMAGE_CACHE_TTL_SECS = 60 * 60
+
+_AMI_IMAGE_CACHE: Dict[Tuple[str, bool, Optional[str]], Tuple[float, Tuple[str, str]]] = {}
+
+_ROLE_NAMES: Dict[str, str] = {}
+
+_INSTANCE_PROFILE_ARNS: Dict[str, str] = {}
+
+_SECURITY_GROUP_IDS: Dict[Tuple[str, Optional[str]], str] = {}
+
+_LOG_GROUPS_ENSURED: Set[str] = set()
+
+RUNNER_BODIES_CACHE_SIZE = 1024
+
+# Runner documents by bucket and key, along with their ETags
+_RUNNER_BODIES: Dict[Tuple[str, str], Tuple[str, bytes]] = {}
+
+_RUNNER_BODIES_LOCK = threading.Lock()
+
+_SPOT_REQUEST_STATUSES = {
+    "fulfilled": RequestStatus.RUNNING,
+    "request-canceled-and-instance-running": RequestStatus.RUNNING,
+    "not-scheduled-yet": RequestStatus.PENDING,
+    "pending-evaluation": RequestStatus.PENDING,
+    "pending-fulfillment": RequestStatus.PENDING,
+    "capacity-not-available": RequestStatus.NO_CAPACITY,
+    "instance-stopped-no-capacity": RequestStatus.NO_CAPACITY,
+    "instance-terminated-by-price": RequestStatus.NO_CAPACITY,
+    "instance-stopped-by-price": RequestStatus.NO_CAPACITY,
+    "instance-terminated-no-capacity": RequestStatus.NO_CAPACITY,
+    "limit-exceeded": RequestStatus.NO_CAPACITY,
+    "price-too-low": RequestStatus.NO_CAPACITY,
+    "instance-terminated-by-user": RequestStatus.TERMINATED,
+    "instance-stopped-by-user": RequestStatus.TERMINATED,
+    "canceled-before-fulfillment": RequestStatus.TERMINATED,
+    "instance-terminated-by-schedule": RequestStatus.TERMINATED,
+    "instance-terminated-by-service": RequestStatus.TERMINATED,
+    "spot-instance-terminated-by-user": RequestStatus.TERMINATED,
+    "marked-for-stop": RequestStatus.TERMINATED,
+    "marked-for-termination": RequestStatus.TERMINATED,
+}
+
+_INSTANCE_STATES = {
+    "running": RequestStatus.RUNNING,
+    "pending": RequestStatus.PENDING,
+    "shutting-down": RequestStatus.TERMINATED,
+    "terminated": RequestStatus.TERMINATED,
+    "stopping": RequestStatus.TERMINATED,
+    "stopped": RequestStatus.TERMINATED,
+}
+
+# EC2 accepts up to 1000 IDs per call, but no more than 200 values per filter
+EC2_IDS_BATCH_SIZE = 200
+
+STOP_JOBS_MAX_WORKERS = 16
+
+# Shared by all stop_jobs calls; the writes submitted to it must not submit to it themselves
+_S3_WRITES_EXECUTOR = ThreadPoolExecutor(max_workers=STOP_JOBS_MAX_WORKERS)
+
+_EARLY_JOB_STATUSES = frozenset([JobStatus.SUBMITTED, JobStatus.DOWNLOADING])
+
 
 def _serialize_runner(runner: Runner) -> dict:
     resources = {
@@ -57,62 +135,71 @@ def _unserialize_runner(data: dict) -> Runner:
     )
 
 
-def _get_instance_types(ec2_client: BaseClient) -> List[InstanceType]:
-    response = None
+def _describe_instance_types(ec2_client: BaseClient, family: str) -> List[InstanceType]:
     instance_types = []
-    while not response or response.get("NextToken"):
-        kwargs = {}
-        if response and "NextToken" in response:
-            kwargs["NextToken"] = response["NextToken"]
-        response = ec2_client.describe_instance_types(
-            Filters=[
-                {
-                    "Name": "instance-type",
-                    "Values": ["c5.*", "m5.*", "p2.*", "p3.*", "p4d.*", "p4de.*"],
-                },
-            ],
-            **kwargs,
-        )
-        for instance_type in response["InstanceTypes"]:
-            gpus = (
-                [
-                    [Gpu(gpu["Name"], gpu["MemoryInfo"]["SizeInMiB"])] * gpu["Count"]
-                    for gpu in instance_type["GpuInfo"]["Gpus"]
-                ]
-                if instance_type.get("GpuInfo") and instance_type["GpuInfo"].get("Gpus")
-                else []
-            )
+    paginator = ec2_client.get_paginator("describe_instance_types")
+    pages = paginator.paginate(
+        Filters=[
+            {
+                "Name": "instance-type",
+                "Values": [family],
+            },
+        ],
+        PaginationConfig={"PageSize": 100},
+    )
+    for page in pages:
+        for instance_type in page["InstanceTypes"]:
+            gpus = [
+                Gpu(gpu["Name"], gpu["MemoryInfo"]["SizeInMiB"])
+                for gpu in (instance_type.get("GpuInfo") or {}).get("Gpus") or []
+                for _ in range(gpu["Count"])
+            ]
             instance_types.append(
                 InstanceType(
                     instance_type["InstanceType"],
                     Resources(
                         instance_type["VCpuInfo"]["DefaultVCpus"],
                         instance_type["MemoryInfo"]["SizeInMiB"],
-                        reduce(list.__add__, gpus) if gpus else [],
+                        gpus,
                         "spot" in instance_type["SupportedUsageClasses"],
                         False,
                     ),
                 )
             )
+    return instance_types
 
-    def compare(i1, i2):
-        r1_gpu_total_memory_mib = sum(map(lambda g: g.memory_mib, i1.resources.gpus or []))
-        r2_gpu_total_memory_mib = sum(map(lambda g: g.memory_mib, i2.resources.gpus or []))
-        if r1_gpu_total_memory_mib < r2_gpu_total_memory_mib:
-            return -1
-        elif r1_gpu_total_memory_mib > r2_gpu_total_memory_mib:
-            return 1
-        if i1.resources.cpus < i2.resources.cpus:
-            return -1
-        elif i1.resources.cpus > i2.resources.cpus:
-            return 1
-        if i1.resources.memory_mib < i2.resources.memory_mib:
-            return -1
-        elif i1.resources.memory_mib > i2.resources.memory_mib:
-            return 1
-        return 0
-
-    return sorted(instance_types, key=cmp_to_key(compare))
+
+def _get_instance_types(ec2_client: BaseClient, families: List[str]) -> List[InstanceType]:
+    with ThreadPoolExecutor(max_workers=len(families)) as executor:
+        instance_types = [
+            instance_type
+            for family_instance_types in executor.map(
+                lambda family: _describe_instance_types(ec2_client, family),
+                families,
+            )
+            for instance_type in family_instance_types
+        ]
+
+    return sorted(
+        instance_types,
+        key=lambda i: (
+            sum(gpu.memory_mib for gpu in i.resources.gpus or []),
+            i.resources.cpus,
+            i.resources.memory_mib,
+        ),
+    )
+
+
+def _get_cached_instance_types(ec2_client: BaseClient, gpu: bool) -> List[InstanceType]:
+    cache_key = (ec2_client.meta.region_name, gpu)
+    cached = _INSTANCE_TYPES_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[0] < INSTANCE_TYPES_CACHE_TTL_SECS:
+        return cached[1]
+    instance_types = _get_instance_types(
+        ec2_client, GPU_INSTANCE_TYPE_FAMILIES if gpu else CPU_INSTANCE_TYPE_FAMILIES
+    )
+    _INSTANCE_TYPES_CACHE[cache_key] = (time.monotonic(), instance_types)
+    return instance_types
 
 
 def _matches(resources: Resources, requirements: Optional[Requirements]) -> bool:
@@ -124,19 +211,15 @@ def _matches(resources: Resources, requirements: Optional[Requirements]) -> bool
         return False
     if requirements.gpus:
         gpu_count = requirements.gpus.count or 1
-        if gpu_count > len(resources.gpus or []):
+        gpus = resources.gpus or []
+        if gpu_count > len(gpus):
             return False
-        if requirements.gpus.name and gpu_count > len(
-            list(filter(lambda gpu: gpu.name == requirements.gpus.name, resources.gpus or []))
+        if requirements.gpus.name and gpu_count > sum(
+            1 for gpu in gpus if gpu.name == requirements.gpus.name
         ):
             return False
-        if requirements.gpus.memory_mib and gpu_count > len(
-            list(
-                filter(
-                    lambda gpu: gpu.memory_mib >= requirements.gpus.memory_mib,
-                    resources.gpus or [],
-                )
-            )
+        if requirements.gpus.memory_mib and gpu_count > sum(
+            1 for gpu in gpus if gpu.memory_mib >= requirements.gpus.memory_mib
         ):
             return False
         if requirements.interruptible and not resources.interruptible:
@@ -144,12 +227,10 @@ def _matches(resources: Resources, requirements: Optional[Requirements]) -> bool
     return True
 
 
-def _get_instance_type(
-    ec2_client: BaseClient, requirements: Optional[Requirements]
+def _find_instance_type(
+    instance_types: List[InstanceType], requirements: Optional[Requirements]
 ) -> Optional[InstanceType]:
-    instance_types = _get_instance_types(ec2_client)
-
-    instance_type = next(
+    return next(
         (
             instance_type
             for instance_type in instance_types
@@ -157,6 +238,22 @@ def _get_instance_type(
         ),
         None,
     )
+
+
+def _get_instance_type(
+    ec2_client: BaseClient,
+    requirements: Optional[Requirements],
+) -> Optional[InstanceType]:
+    instance_type = None
+    if not requirements or not requirements.gpus:
+        instance_type = _find_instance_type(
+            _get_cached_instance_types(ec2_client, gpu=False), requirements
+        )
+    # GPU instance types also serve CPU-only jobs that don't fit any CPU instance type
+    if instance_type is None:
+        instance_type = _find_instance_type(
+            _get_cached_instance_types(ec2_client, gpu=True), requirements
+        )
     return (
         InstanceType(
             instance_type.instance_name,
@@ -181,13 +278,15 @@ def _create_runner(
     if runner.job.status == JobStatus.STOPPING:
         metadata["status"] = "stopping"
     s3_client.put_object(
-        Body=yaml.dump(_serialize_runner(runner)),
+        Body=yaml.dump(_serialize_runner(runner), Dumper=yaml.SafeDumper),
         Bucket=bucket_name,
         Key=key,
         Metadata=metadata,
     )
     log_group_name = f"/dstack/runners/{bucket_name}"
-    logs.create_log_group_if_not_exists(logs_client, bucket_name, log_group_name)
+    if log_group_name not in _LOG_GROUPS_ENSURED:
+        logs.create_log_group_if_not_exists(logs_client, bucket_name, log_group_name)
+        _LOG_GROUPS_ENSURED.add(log_group_name)
 
 
 def _update_runner(s3_client: BaseClient, bucket_name: str, runner: Runner):
@@ -196,7 +295,7 @@ def _update_runner(s3_client: BaseClient, bucket_name: str, runner: Runner):
     if runner.job.status == JobStatus.STOPPING:
         metadata["status"] = "stopping"
     s3_client.put_object(
-        Body=yaml.dump(_serialize_runner(runner)),
+        Body=yaml.dump(_serialize_runner(runner), Dumper=yaml.SafeDumper),
         Bucket=bucket_name,
         Key=key,
         Metadata=metadata,
@@ -204,6 +303,8 @@ def _update_runner(s3_client: BaseClient, bucket_name: str, runner: Runner):
 
 
 def get_security_group_id(ec2_client: BaseClient, bucket_name: str, subnet_id: Optional[str]):
+    if (bucket_name, subnet_id) in _SECURITY_GROUP_IDS:
+        return _SECURITY_GROUP_IDS[(bucket_name, subnet_id)]
     _subnet_postfix = (subnet_id.replace("-", "_") + "_") if subnet_id else ""
     security_group_name = (
         "dstack_security_group_" + _subnet_postfix + bucket_name.replace("-", "_").lower()
@@ -270,6 +371,7 @@ def get_security_group_id(ec2_client: BaseClient, bucket_name: str, subnet_id: O
                 }
             ],
         )
+    _SECURITY_GROUP_IDS[(bucket_name, subnet_id)] = security_group_id
     return security_group_id
 
 
@@ -283,21 +385,22 @@ def _serialize_runner_yaml(
     runner_port_range_from: int,
     runner_port_range_to: int,
 ):
-    s = (
-        f"id: {runner_id}\\n"
-        f"expose_ports: {runner_port_range_from}-{runner_port_range_to}\\n"
-        f"resources:\\n"
-    )
-    s += f"  cpus: {resources.cpus}\\n"
+    lines = [
+        f"id: {runner_id}",
+        f"expose_ports: {runner_port_range_from}-{runner_port_range_to}",
+        "resources:",
+        f"  cpus: {resources.cpus}",
+    ]
     if resources.gpus:
-        s += "  gpus:\\n"
+        lines.append("  gpus:")
         for gpu in resources.gpus:
-            s += f"    - name: {gpu.name}\\n      memory_mib: {gpu.memory_mib}\\n"
+            lines.append(f"    - name: {gpu.name}")
+            lines.append(f"      memory_mib: {gpu.memory_mib}")
     if resources.interruptible:
-        s += "  interruptible: true\\n"
+        lines.append("  interruptible: true")
     if resources.local:
-        s += "  local: true\\n"
-    return s[:-2]
+        lines.append("  local: true")
+    return "\\n".join(lines)
 
 
 def _user_data(
@@ -333,6 +436,8 @@ HOME=/root nohup dstack-runner start --http-port 4000 &
 
 
 def role_name(iam_client: BaseClient, bucket_name: str) -> str:
+    if bucket_name in _ROLE_NAMES:
+        return _ROLE_NAMES[bucket_name]
     policy_name = "dstack_policy_" + bucket_name.replace("-", "_").lower()
     _role_name = "dstack_role_" + bucket_name.replace("-", "_").lower()
     try:
@@ -409,14 +514,17 @@ def role_name(iam_client: BaseClient, bucket_name: str) -> str:
             iam_client.attach_role_policy(RoleName=_role_name, PolicyArn=policy_arn)
         else:
             raise e
+    _ROLE_NAMES[bucket_name] = _role_name
     return _role_name
 
 
 def instance_profile_arn(iam_client: BaseClient, bucket_name: str) -> str:
+    if bucket_name in _INSTANCE_PROFILE_ARNS:
+        return _INSTANCE_PROFILE_ARNS[bucket_name]
     _role_name = role_name(iam_client, bucket_name)
     try:
         response = iam_client.get_instance_profile(InstanceProfileName=_role_name)
-        return response["InstanceProfile"]["Arn"]
+        _instance_profile_arn = response["InstanceProfile"]["Arn"]
     except Exception as e:
         if (
             hasattr(e, "response")
@@ -435,9 +543,10 @@ def instance_profile_arn(iam_client: BaseClient, bucket_name: str) -> str:
                 InstanceProfileName=_role_name,
                 RoleName=_role_name,
             )
-            return _instance_profile_arn
         else:
             raise e
+    _INSTANCE_PROFILE_ARNS[bucket_name] = _instance_profile_arn
+    return _instance_profile_arn
 
 
 def _get_default_ami_image_version() -> Optional[str]:
@@ -450,8 +559,20 @@ def _get_default_ami_image_version() -> Optional[str]:
 def _get_ami_image(
     ec2_client: BaseClient,
     cuda: bool,
-    _version: Optional[str] = _get_default_ami_image_version(),
+    _version: Optional[str] = None,
 ) -> Tuple[str, str]:
+    if _version is None:
+        _version = _get_default_ami_image_version()
+    return _find_ami_image(ec2_client, cuda, _version)
+
+
+def _find_ami_image(
+    ec2_client: BaseClient, cuda: bool, _version: Optional[str]
+) -> Tuple[str, str]:
+    cache_key = (ec2_client.meta.region_name, cuda, _version)
+    cached = _AMI_IMAGE_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[0] < AMI_IMAGE_CACHE_TTL_SECS:
+        return cached[1]
     ami_name = "dstack"
     if cuda:
         ami_name = ami_name + "-cuda-11.1"
@@ -470,13 +591,15 @@ def _get_ami_image(
         )
     )
     if images:
-        ami = next(iter(sorted(images, key=lambda i: i["CreationDate"], reverse=True)))
-        return ami["ImageId"], ami["Name"]
+        ami = max(images, key=lambda i: i["CreationDate"])
+        image = ami["ImageId"], ami["Name"]
     else:
         if _version:
-            return _get_ami_image(ec2_client, cuda, _version=None)
+            image = _find_ami_image(ec2_client, cuda, None)
         else:
             raise Exception(f"Can't find an AMI image prefix='{ami_name}")
+    _AMI_IMAGE_CACHE[cache_key] = (time.monotonic(), image)
+    return image
 
 
 def _run_instance(
@@ -524,6 +647,7 @@ def _run_instance(
         tags.append({"Key": "dstack_user_name", "Value": local_repo_user_name})
     if local_repo_user_email:
         tags.append({"Key": "dstack_user_email", "Value": local_repo_user_email})
+    image_id, _ = _get_ami_image(ec2_client, len(instance_type.resources.gpus) > 0)
     response = ec2_client.run_instances(
         BlockDeviceMappings=[
             {
@@ -534,7 +658,7 @@ def _run_instance(
                 },
             }
         ],
-        ImageId=_get_ami_image(ec2_client, len(instance_type.resources.gpus) > 0)[0],
+        ImageId=image_id,
         InstanceType=instance_type.instance_name,
         MinCount=1,
         MaxCount=1,
@@ -571,44 +695,40 @@ def _run_instance_retry(
     repo_address: RepoAddress,
     attempts: int = 3,
 ) -> str:
-    try:
-        return _run_instance(
-            ec2_client,
-            iam_client,
-            bucket_name,
-            region_name,
-            subnet_id,
-            runner_id,
-            instance_type,
-            local_repo_user_name,
-            local_repo_user_email,
-            repo_address,
-        )
-    except Exception as e:
-        if (
-            hasattr(e, "response")
-            and e.response.get("Error")
-            and e.response["Error"].get("Code") == "InvalidParameterValue"
-        ):
-            if attempts > 0:
-                time.sleep(CREATE_INSTANCE_RETRY_RATE_SECS)
-                return _run_instance_retry(
-                    ec2_client,
-                    iam_client,
-                    bucket_name,
-                    region_name,
-                    subnet_id,
-                    runner_id,
-                    instance_type,
-                    local_repo_user_name,
-                    local_repo_user_email,
-                    repo_address,
-                    attempts - 1,
-                )
+    attempt = 0
+    while True:
+        try:
+            return _run_instance(
+                ec2_client,
+                iam_client,
+                bucket_name,
+                region_name,
+                subnet_id,
+                runner_id,
+                instance_type,
+                local_repo_user_name,
+                local_repo_user_email,
+                repo_address,
+            )
+        except Exception as e:
+            if (
+                hasattr(e, "response")
+                and e.response.get("Error")
+                and e.response["Error"].get("Code") == "InvalidParameterValue"
+            ):
+                if attempt < attempts:
+                    time.sleep(
+                        min(
+                            CREATE_INSTANCE_RETRY_RATE_SECS * 2**attempt,
+                            CREATE_INSTANCE_RETRY_MAX_SECS,
+                        )
+                        + random.uniform(0, 1)
+                    )
+                    attempt += 1
+                else:
+                    raise Exception("Failed to retry", e)
             else:
-                raise Exception("Failed to retry", e)
-        else:
-            raise e
+                raise e
 
 
 def run_job(
@@ -635,20 +755,27 @@ def run_job(
             sys.exit(f"No instance type matching requirements.")
 
         runner = Runner(job.runner_id, None, instance_type.resources, job)
-        _create_runner(logs_client, s3_client, bucket_name, runner)
-        runner.request_id = _run_instance_retry(
-            ec2_client,
-            iam_client,
-            bucket_name,
-            region_name,
-            subnet_id,
-            job.runner_id,
-            instance_type,
-            job.local_repo_user_name,
-            job.local_repo_user_email,
-            job.repo_address,
-        )
-        _update_runner(s3_client, bucket_name, runner)
+        try:
+            runner.request_id = _run_instance_retry(
+                ec2_client,
+                iam_client,
+                bucket_name,
+                region_name,
+                subnet_id,
+                job.runner_id,
+                instance_type,
+                job.local_repo_user_name,
+                job.local_repo_user_email,
+                job.repo_address,
+            )
+        finally:
+            try:
+                _create_runner(logs_client, s3_client, bucket_name, runner)
+            except Exception:
+                # Nothing could stop the instance later as the job is failed and has no runner
+                if runner.request_id:
+                    _stop_runners(ec2_client, [runner])
+                raise
     except Exception as e:
         job.status = JobStatus.FAILED
         job.request_id = runner.request_id if runner else None
@@ -659,35 +786,95 @@ def run_job(
 def _delete_runner(s3_client: BaseClient, bucket_name: str, runner: Runner):
     key = f"runners/{runner.runner_id}.yaml"
     s3_client.delete_object(Bucket=bucket_name, Key=key)
+    with _RUNNER_BODIES_LOCK:
+        _RUNNER_BODIES.pop((bucket_name, key), None)
 
 
 def _get_runner(s3_client: BaseClient, bucket_name: str, runner_id: str) -> Optional[Runner]:
     key = f"runners/{runner_id}.yaml"
+    with _RUNNER_BODIES_LOCK:
+        cached = _RUNNER_BODIES.get((bucket_name, key))
     try:
-        obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-        return _unserialize_runner(yaml.load(obj["Body"].read().decode("utf-8"), yaml.FullLoader))
+        if cached:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key, IfNoneMatch=cached[0])
+        else:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+        body = obj["Body"].read()
+        with _RUNNER_BODIES_LOCK:
+            _RUNNER_BODIES[(bucket_name, key)] = (obj["ETag"], body)
+            if len(_RUNNER_BODIES) > RUNNER_BODIES_CACHE_SIZE:
+                del _RUNNER_BODIES[next(iter(_RUNNER_BODIES))]
     except Exception as e:
         if (
+            cached
+            and hasattr(e, "response")
+            and e.response.get("Error")
+            and e.response["Error"].get("Code") == "304"
+        ):
+            # Not modified since the last read
+            body = cached[1]
+        elif (
             hasattr(e, "response")
             and e.response.get("Error")
             and e.response["Error"].get("Code") == "NoSuchKey"
         ):
+            with _RUNNER_BODIES_LOCK:
+                _RUNNER_BODIES.pop((bucket_name, key), None)
             return None
         else:
             raise e
+    if body.startswith(b"{"):
+        # Runners written as JSON by earlier versions
+        data = json.loads(body)
+    else:
+        try:
+            data = yaml.load(body, SafeLoader)
+        except yaml.YAMLError:
+            # libyaml rejects the escaped lone surrogates that PyYAML writes for undecodable diffs
+            data = yaml.load(body, yaml.SafeLoader)
+    return _unserialize_runner(data)
 
 
 def _cancel_spot_request(ec2_client: BaseClient, request_id: str):
-    ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-    response = ec2_client.describe_instances(
-        Filters=[
-            {"Name": "spot-instance-request-id", "Values": [request_id]},
-        ],
-    )
-    if response.get("Reservations") and response["Reservations"][0].get("Instances"):
-        ec2_client.terminate_instances(
-            InstanceIds=[response["Reservations"][0]["Instances"][0]["InstanceId"]]
+    try:
+        ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
+    except Exception as e:
+        if (
+            hasattr(e, "response")
+            and e.response.get("Error")
+            and e.response["Error"].get("Code") == "InvalidSpotInstanceRequestID.NotFound"
+        ):
+            pass
+        else:
+            raise e
+
+
+def _cancel_spot_requests(ec2_client: BaseClient, request_ids: List[str]) -> List[str]:
+    instance_ids = []
+    for i in range(0, len(request_ids), EC2_IDS_BATCH_SIZE):
+        batch = request_ids[i : i + EC2_IDS_BATCH_SIZE]
+        try:
+            ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=batch)
+        except Exception as e:
+            if (
+                hasattr(e, "response")
+                and e.response.get("Error")
+                and e.response["Error"].get("Code") == "InvalidSpotInstanceRequestID.NotFound"
+            ):
+                # The whole call fails if any of the requests is gone
+                for request_id in batch:
+                    _cancel_spot_request(ec2_client, request_id)
+            else:
+                raise e
+        response = ec2_client.describe_instances(
+            Filters=[
+                {"Name": "spot-instance-request-id", "Values": batch},
+            ],
         )
+        for reservation in response.get("Reservations") or []:
+            for instance in reservation.get("Instances") or []:
+                instance_ids.append(instance["InstanceId"])
+    return instance_ids
 
 
 def _terminate_instance(ec2_client: BaseClient, request_id: str):
@@ -704,6 +891,24 @@ def _terminate_instance(ec2_client: BaseClient, request_id: str):
             raise e
 
 
+def _terminate_instances(ec2_client: BaseClient, instance_ids: List[str]):
+    for i in range(0, len(instance_ids), EC2_IDS_BATCH_SIZE):
+        batch = instance_ids[i : i + EC2_IDS_BATCH_SIZE]
+        try:
+            ec2_client.terminate_instances(InstanceIds=batch)
+        except Exception as e:
+            if (
+                hasattr(e, "response")
+                and e.response.get("Error")
+                and e.response["Error"].get("Code") == "InvalidInstanceID.NotFound"
+            ):
+                # The whole call fails if any of the instances is gone
+                for instance_id in batch:
+                    _terminate_instance(ec2_client, instance_id)
+            else:
+                raise e
+
+
 def get_request_head(
     ec2_client: BaseClient,
     s3_client: BaseClient,
@@ -736,39 +941,8 @@ def get_request_head(
                 )
                 if response.get("SpotInstanceRequests"):
                     status = response["SpotInstanceRequests"][0]["Status"]
-                    if status["Code"] in [
-                        "fulfilled",
-                        "request-canceled-and-instance-running",
-                    ]:
-                        request_status = RequestStatus.RUNNING
-                    elif status["Code"] in [
-                        "not-scheduled-yet",
-                        "pending-evaluation",
-                        "pending-fulfillment",
-                    ]:
-                        request_status = RequestStatus.PENDING
-                    elif status["Code"] in [
-                        "capacity-not-available",
-                        "instance-stopped-no-capacity",
-                        "instance-terminated-by-price",
-                        "instance-stopped-by-price",
-                        "instance-terminated-no-capacity",
-                        "limit-exceeded",
-                        "price-too-low",
-                    ]:
-                        request_status = RequestStatus.NO_CAPACITY
-                    elif status["Code"] in [
-                        "instance-terminated-by-user",
-                        "instance-stopped-by-user",
-                        "canceled-before-fulfillment",
-                        "instance-terminated-by-schedule",
-                        "instance-terminated-by-service",
-                        "spot-instance-terminated-by-user",
-                        "marked-for-stop",
-                        "marked-for-termination",
-                    ]:
-                        request_status = RequestStatus.TERMINATED
-                    else:
+                    request_status = _SPOT_REQUEST_STATUSES.get(status["Code"])
+                    if request_status is None:
                         raise Exception(
                             f"Unsupported EC2 spot instance request status code: {status['Code']}"
                         )
@@ -793,18 +967,8 @@ def get_request_head(
                 response = ec2_client.describe_instances(InstanceIds=[request_id])
                 if response.get("Reservations") and response["Reservations"][0].get("Instances"):
                     state = response["Reservations"][0]["Instances"][0]["State"]
-                    if state["Name"] in ["running"]:
-                        request_status = RequestStatus.RUNNING
-                    elif state["Name"] in ["pending"]:
-                        request_status = RequestStatus.PENDING
-                    elif state["Name"] in [
-                        "shutting-down",
-                        "terminated",
-                        "stopping",
-                        "stopped",
-                    ]:
-                        request_status = RequestStatus.TERMINATED
-                    else:
+                    request_status = _INSTANCE_STATES.get(state["Name"])
+                    if request_status is None:
                         raise Exception(f"Unsupported EC2 instance state name: {state['Name']}")
                     return RequestHead(job.job_id, request_status, None)
                 else:
@@ -831,77 +995,169 @@ def get_request_head(
         return RequestHead(job.job_id, RequestStatus.TERMINATED, message)
 
 
-def _stop_runner(ec2_client: BaseClient, s3_client: BaseClient, bucket_name: str, runner: Runner):
-    if runner.request_id:
-        if runner.resources.local:
-            pass
-            # local.stop_process(runner.request_id) IVAN
-        elif runner.resources.interruptible:
-            _cancel_spot_request(ec2_client, runner.request_id)
-        else:
-            _terminate_instance(ec2_client, runner.request_id)
-    _delete_runner(s3_client, bucket_name, runner)
+def _stop_runners(ec2_client: BaseClient, runners: List[Runner]):
+    spot_request_ids = []
+    instance_ids = []
+    for runner in runners:
+        if runner.request_id:
+            if runner.resources.local:
+                pass
+                # local.stop_process(runner.request_id) IVAN
+            elif runner.resources.interruptible:
+                spot_request_ids.append(runner.request_id)
+            else:
+                instance_ids.append(runner.request_id)
+    if spot_request_ids:
+        instance_ids.extend(_cancel_spot_requests(ec2_client, spot_request_ids))
+    if instance_ids:
+        _terminate_instances(ec2_client, instance_ids)
 
 
-def stop_job(
+def _get_job_stop_state(
     ec2_client: BaseClient,
     s3_client: BaseClient,
     bucket_name: str,
     repo_address: RepoAddress,
     job_id: str,
     abort: bool,
+) -> Tuple[Optional[JobHead], Optional[Job], Optional[Runner], Optional[RequestStatus]]:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        job_head_future = executor.submit(
+            jobs.list_job_head, s3_client, bucket_name, repo_address, job_id
+        )
+        job = jobs.get_job(s3_client, bucket_name, repo_address, job_id)
+        runner = None
+        # The request status only decides between stopping and stopped for a job that is past
+        # downloading and still has something unfinished; it's not looked up otherwise
+        request_status = None
+        if job:
+            runner_future = executor.submit(_get_runner, s3_client, bucket_name, job.runner_id)
+            job_head = job_head_future.result()
+            needs_request_status = (
+                not abort
+                and job_head is not None
+                and job_head.status not in _EARLY_JOB_STATUSES
+                and job.status not in _EARLY_JOB_STATUSES
+            )
+            job_or_head_unfinished = job.status.is_unfinished() or (
+                job_head is not None and job_head.status.is_unfinished()
+            )
+            if needs_request_status and job_or_head_unfinished and job.request_id:
+                # The request status doesn't depend on the runner if the job knows the request
+                request_status = get_request_head(ec2_client, s3_client, bucket_name, job).status
+                runner = runner_future.result()
+            else:
+                runner = runner_future.result()
+                if (
+                    needs_request_status
+                    and runner
+                    and (job_or_head_unfinished or runner.job.status.is_unfinished())
+                ):
+                    request_status = get_request_head(
+                        ec2_client, s3_client, bucket_name, job, runner
+                    ).status
+        else:
+            job_head = job_head_future.result()
+    return job_head, job, runner, request_status
+
+
+def stop_jobs(
+    ec2_client: BaseClient,
+    s3_client: BaseClient,
+    bucket_name: str,
+    repo_address: RepoAddress,
+    job_ids: List[str],
+    abort: bool,
 ):
-    job_head = jobs.list_job_head(s3_client, bucket_name, repo_address, job_id)
-    job = jobs.get_job(s3_client, bucket_name, repo_address, job_id)
-    runner = _get_runner(s3_client, bucket_name, job.runner_id) if job else None
-    request_status = (
-        get_request_head(ec2_client, s3_client, bucket_name, job, runner).status
-        if job
-        else RequestStatus.TERMINATED
-    )
-    if (
-        job_head
-        and job_head.status.is_unfinished()
-        or job
-        and job.status.is_unfinished()
-        or runner
-        and runner.job.status.is_unfinished()
-        or request_status != RequestStatus.TERMINATED
-    ):
-        if abort:
-            new_status = JobStatus.ABORTED
-        elif (
-            not job_head
-            or job_head.status in [JobStatus.SUBMITTED, JobStatus.DOWNLOADING]
-            or not job
-            or job.status in [JobStatus.SUBMITTED, JobStatus.DOWNLOADING]
-            or request_status == RequestStatus.TERMINATED
-            or not runner
-        ):
-            new_status = JobStatus.STOPPED
-        elif (
-            job_head
-            and job_head.status != JobStatus.UPLOADING
-            or job
-            and job.status != JobStatus.UPLOADING
+    if not job_ids:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(job_ids), STOP_JOBS_MAX_WORKERS)) as executor:
+        job_stop_states = list(
+            executor.map(
+                lambda job_id: _get_job_stop_state(
+                    ec2_client, s3_client, bucket_name, repo_address, job_id, abort
+                ),
+                job_ids,
+            )
+        )
+    runners_to_stop = []
+    runners_to_update = []
+    jobs_to_update = []
+    for job_head, job, runner, request_status in job_stop_states:
+        job_head_status = job_head.status if job_head else None
+        job_status = job.status if job else None
+        runner_job_status = runner.job.status if runner else None
+        job_head_early = job_head_status in _EARLY_JOB_STATUSES
+        job_early = job_status in _EARLY_JOB_STATUSES
+        job_head_unfinished = bool(job_head_status and job_head_status.is_unfinished())
+        job_unfinished = bool(job_status and job_status.is_unfinished())
+        runner_job_unfinished = bool(runner_job_status and runner_job_status.is_unfinished())
+        if (
+            request_status != RequestStatus.TERMINATED
+            or job_head_unfinished
+            or job_unfinished
+            or runner_job_unfinished
         ):
-            new_status = JobStatus.STOPPING
-        else:
-            new_status = None
-        if new_status:
-            if runner and runner.job.status.is_unfinished() and runner.job.status != new_status:
+            if abort:
+                new_status = JobStatus.ABORTED
+            elif (
+                not job_head
+                or job_head_early
+                or not job
+                or job_early
+                or request_status == RequestStatus.TERMINATED
+                or not runner
+            ):
+                new_status = JobStatus.STOPPED
+            elif job_head_status != JobStatus.UPLOADING or job_status != JobStatus.UPLOADING:
+                new_status = JobStatus.STOPPING
+            else:
+                # The job is uploading its artifacts and will finish by itself
+                continue
+            if runner_job_unfinished and runner_job_status != new_status:
                 if new_status.is_finished():
-                    _stop_runner(ec2_client, s3_client, bucket_name, runner)
+                    runners_to_stop.append(runner)
                 else:
                     runner.job.status = new_status
-                    _update_runner(s3_client, bucket_name, runner)
-            if (
-                job_head
-                and job_head.status.is_unfinished()
-                and job_head.status != new_status
-                or job
-                and job.status.is_unfinished()
-                and job.status != new_status
+                    runners_to_update.append(runner)
+            # There's nothing to update if only the job head is left
+            if job and (
+                job_head_unfinished
+                and job_head_status != new_status
+                or job_unfinished
+                and job_status != new_status
             ):
                 job.status = new_status
-                jobs.update_job(s3_client, bucket_name, job)
+                jobs_to_update.append(job)
+    # The runners are stopped before the jobs are marked as finished, so that a failed stop can
+    # be retried; only the updates of runners that keep running go out in the meantime
+    futures = [
+        _S3_WRITES_EXECUTOR.submit(_update_runner, s3_client, bucket_name, runner)
+        for runner in runners_to_update
+    ]
+    try:
+        if runners_to_stop:
+            _stop_runners(ec2_client, runners_to_stop)
+        futures += [
+            _S3_WRITES_EXECUTOR.submit(jobs.update_job, s3_client, bucket_name, job)
+            for job in jobs_to_update
+        ]
+        futures += [
+            _S3_WRITES_EXECUTOR.submit(_delete_runner, s3_client, bucket_name, runner)
+            for runner in runners_to_stop
+        ]
+    finally:
+        wait(futures)
+    for future in futures:
+        future.result()
+
+
+def stop_job(
+    ec2_client: BaseClient,
+    s3_client: BaseClient,
+    bucket_name: str,
+    repo_address: RepoAddress,
+    job_id: str,
+    abort: bool,
+):
+    stop_jobs(ec2_client, s3_client, bucket_name, repo_address, [job_id], abort)
@@ -71,11 +71,12 @@ class Backend(ABC):
     def stop_job(self, repo_address: RepoAddress, job_id: str, abort: bool):
         pass
 
-    def stop_jobs(self, repo_address: RepoAddress, run_name: Optional[str], abort: bool):
+    def stop_jobs(self, repo_address: RepoAddress, run_name: Optional[str], abort: bool) -> bool:
         job_heads = self.list_job_heads(repo_address, run_name)
         for job_head in job_heads:
             if job_head.status.is_unfinished():
                 self.stop_job(repo_address, job_head.job_id, abort)
+        return bool(job_heads)
 
     @abstractmethod
     def list_job_heads(
@@ -57,11 +57,7 @@ class StopCommand(BasicCommand):
         ) or (args.all and (args.yes or Confirm.ask(f"[red]{_verb(args.abort)} all runs?[/]"))):
             repo_data = load_repo_data()
             for backend in list_backends():
-                job_heads = backend.list_job_heads(repo_data, args.run_name)
-                if job_heads:
-                    for job_head in job_heads:
-                        if job_head.status.is_unfinished():
-                            backend.stop_job(repo_data, job_head.job_id, args.abort)
+                if backend.stop_jobs(repo_data, args.run_name, args.abort):
                     print(f"[grey58]OK[/]")
                     return
             sys.exit(f"Cannot find the run '{args.run_name}'")
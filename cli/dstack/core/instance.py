@@ -2,6 +2,8 @@ from dstack.core.runners import Resources
 
 
 class InstanceType:
+    __slots__ = ("instance_name", "resources")
+
     def __init__(self, instance_name: str, resources: Resources):
         self.instance_name = instance_name
         self.resources = resources
@@ -4,6 +4,8 @@ from dstack.core.job import Job
 
 
 class Gpu:
+    __slots__ = ("name", "memory_mib")
+
     def __init__(self, name: str, memory_mib: int):
         self.memory_mib = memory_mib
         self.name = name
@@ -13,6 +15,8 @@ class Gpu:
 
 
 class Resources:
+    __slots__ = ("cpus", "memory_mib", "gpus", "interruptible", "local")
+
     def __init__(
         self,
         cpus: int,